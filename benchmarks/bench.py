@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
+import argparse # ArgumentParser
+import concurrent.futures # ProcessPoolExecutor, wait
 import itertools # count
 import math # sqrt
 import multiprocessing # cpu_count
@@ -11,30 +13,72 @@ import subprocess # Popen, call
 import sys # stdout, exit
 import time # sleep
 
-def extract(content, thing, letter):
-    s = re.compile(thing+r':[\W]*([\d\.]+)').findall(content)
-    return len(s) == 1 and {letter: s[0]} or {}
+# map benchmark output labels to short result keys
+_result_keys = {b"Time": "Ti",
+                b"Steal work": "Sw", b"Leap work": "Lw",
+                b"Steal overhead": "So", b"Leap overhead": "Lo",
+                b"Steal search": "Ss", b"Leap search": "Ls"}
+_result_re = re.compile(rb'(' + b'|'.join(_result_keys) + rb'):[\W]*([\d\.]+)')
 
 def proc_result(content):
-    times = {}
-    for a,b in [("Time","Ti"), 
-                ("Steal work","Sw"), ("Leap work","Lw"), 
-                ("Steal overhead","So"), ("Leap overhead","Lo"), 
-                ("Steal search","Ss"), ("Leap search","Ls")]:
-        times.update(extract(content, a, b))
-    return times
+    # extract all labels from the raw bytes in a single scan, without
+    # decoding the whole log; only keep labels that appear exactly once
+    found = {}
+    for label, value in _result_re.findall(content):
+        key = _result_keys[label]
+        found[key] = value.decode('ascii') if key not in found else None
+    return {k: v for k, v in found.items() if v != None}
 
 def results_to_file(results, filename):
-    with open(filename, "w") as out:
-        out.write("Name; Workers; Key; Value\n")
-        for name, workers, result in results:
-            out.write("{};{};Ti;{}\n".format(name, workers, result))
+    # build the whole file in memory and write it with a single call
+    lines = ["Name; Workers; Key; Value"]
+    lines.extend("{};{};Ti;{}".format(name, workers, result) for name, workers, result in results)
+    with open(filename, "w", buffering=1<<20) as out:
+        out.write("\n".join(lines) + "\n")
+
+# parsed result files, keyed by filename, with the mtime at parse time
+_parse_cache = {}
+
+def drop_caches(paths):
+    # Evict the given files from the OS page cache, so that a run does not
+    # benefit from pages warmed up by previous runs. If we are root, also
+    # drop the page cache itself.
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    if hasattr(os, "geteuid") and os.geteuid() == 0:
+        subprocess.call(["sync"])
+        try:
+            with open("/proc/sys/vm/drop_caches", "w") as f:
+                f.write("3")
+        except OSError:
+            pass
+
+def run_item_file(name, args, workers, filename, fresh=False, cores=None, cold=False):
+    # pin ourselves (and thus the benchmark child) to the assigned cores;
+    # if the kernel refuses the mask, run unpinned rather than fail
+    if cores is not None and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError:
+            pass
 
-def run_item_file(name, args, workers, filename, dry=False, fresh=False):
     if os.path.isfile(filename):
-        # existing file
-        with open(filename, "r") as out:
-            times = proc_result(out.read())
+        # existing file; reuse the parsed results if the file is unchanged
+        st = os.stat(filename)
+        cached = _parse_cache.get(filename)
+        if cached != None and cached[0] == st.st_mtime_ns:
+            times = cached[1]
+        else:
+            with open(filename, "rb") as out:
+                times = proc_result(out.read())
+            _parse_cache[filename] = (st.st_mtime_ns, times)
         if times and 'Ti' in times:
             if fresh: return None
             print("Retrieved {}-{} from previous run... {} seconds!".format(name, workers, times["Ti"]))
@@ -42,8 +86,7 @@ def run_item_file(name, args, workers, filename, dry=False, fresh=False):
         else:
             print("Discarding previous run of {}-{}.".format(name, workers))
             os.unlink(filename)
-
-    if dry: return None
+            _parse_cache.pop(filename, None)
 
     if not os.path.isfile(args[0]):
         print("Program {} does not exist!".format(args[0]))
@@ -51,17 +94,34 @@ def run_item_file(name, args, workers, filename, dry=False, fresh=False):
 
     print("Performing {}-{}... ".format(name, workers), end='')
     sys.stdout.flush()
+    if cold: drop_caches([args[0]])
+
+    # write to a temporary file and only move it into place when the run
+    # completed, so an interrupted run never leaves a half-written file
+    tmpname = filename + ".tmp"
     try:
-        with open(filename, "w+") as out:
-            subprocess.call(args, stdout=out, stderr=out)
-            out.seek(0)
-            times = proc_result(out.read())
+        # stream the output through a pipe, copying it to the result file
+        # while keeping it in memory for parsing
+        t0 = time.monotonic()
+        with open(tmpname, "wb") as out:
+            # close_fds=False lets CPython start the child with posix_spawn
+            # instead of fork+exec, avoiding a copy of our page tables
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=False)
+            chunks = []
+            while True:
+                chunk = proc.stdout.read(1<<16)
+                if not chunk: break
+                out.write(chunk)
+                chunks.append(chunk)
+            proc.wait()
+        times = proc_result(b"".join(chunks))
+        os.replace(tmpname, filename)
     except KeyboardInterrupt:
-        os.unlink(filename)
+        os.unlink(tmpname)
         print("interrupted!")
         sys.exit()
     except OSError:
-        os.unlink(filename)
+        os.unlink(tmpname)
         print("failure! (Program may not have been compiled)")
         sys.exit()
     else:
@@ -69,24 +129,65 @@ def run_item_file(name, args, workers, filename, dry=False, fresh=False):
             print("done in %s seconds!" % times["Ti"])
         else:
             print("done, but no result!")
-        time.sleep(2)
+        # cool down proportionally to the run duration, so short runs do
+        # not pay a fixed 2 second penalty
+        time.sleep(min(2.0, 0.1 * (time.monotonic() - t0)))
         return times
 
-def online_variance(data):
-    n = 0
-    mean = 0
-    M2 = 0
- 
-    for x in data:
-        n = n + 1
-        delta = x - mean
-        mean = mean + delta/n
-        M2 = M2 + delta*(x - mean)
-
-    if n < 2: return n, mean, float('nan')
- 
-    variance = M2/(n - 1)
-    return n, mean, variance
+def run_iteration(experiments, outdir, i, max_cores, cold=False):
+    # Run one iteration of all experiments, packing runs with a combined
+    # worker count of at most max_cores onto the machine at the same time.
+    # Each run is pinned to its own contiguous range of cores.
+    results = []
+    pending = list(experiments)
+    # dispatch longest-expected-first (by observed mean runtime) to minimize
+    # the makespan of the packed schedule; experiments without an observed
+    # mean go first, and the shuffle keeps equal runtimes randomly ordered
+    random.shuffle(pending)
+    pending.sort(key=lambda e: -agg.get((e[0], e[2]), (0, float('inf'), 0))[1])
+    # assign cores from the CPUs we are actually allowed to run on; the
+    # allowed ids need not start at 0 (taskset, cgroups)
+    if hasattr(os, "sched_getaffinity") and len(os.sched_getaffinity(0)) >= max_cores:
+        free = sorted(os.sched_getaffinity(0))[:max_cores]
+    else:
+        free = list(range(max_cores))
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_cores) as pool:
+        try:
+            while pending or running:
+                waiting = []
+                for name, call, workers in pending:
+                    if workers <= len(free):
+                        cores, free = free[:workers], free[workers:]
+                        filename = "{}/{}-{}-{}".format(outdir, name, workers, i)
+                        fut = pool.submit(run_item_file, name, call, workers, filename, fresh=True, cores=cores, cold=cold)
+                        running[fut] = (name, workers, cores)
+                    else:
+                        waiting.append((name, call, workers))
+                pending = waiting
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    name, workers, cores = running.pop(fut)
+                    free = sorted(free + cores)
+                    result = fut.result()
+                    if result != None: results.append((name, workers, float(result['Ti'])))
+        except KeyboardInterrupt:
+            print("interrupted!")
+            sys.exit()
+    return results
+
+# per-(name, workers) running statistics (Welford): (n, mean, M2)
+agg = {}
+
+def record_result(results, name, workers, t):
+    # append to the raw results and update the running statistics
+    results.append((name, workers, t))
+    n, mean, M2 = agg.get((name, workers), (0, 0.0, 0.0))
+    n += 1
+    delta = t - mean
+    mean += delta / n
+    M2 += delta * (t - mean)
+    agg[(name, workers)] = (n, mean, M2)
 
 # ====================================
 # Small Workloads (~4 million nodes):
@@ -140,18 +241,20 @@ T2XXL="-t 0 -b 2000 -q 0.499999995 -m 2 -r 0"
 T1WL="-t 1 -a 3 -d 18 -b 4 -r 19"
 # (T2WL) Binomial -------------- Tree size = 295393891003, tree depth = 1021239, num leaves = 147696946501 (50.00%)
 T2WL="-t 0 -b 2000 -q 0.4999999995 -m 2 -r 559"
-# (T3WL) Binomial -------------- Tree size = 157063495159, tree depth = 758577, num leaves = 78531748579 (50.00%) 
+# (T3WL) Binomial -------------- Tree size = 157063495159, tree depth = 758577, num leaves = 78531748579 (50.00%)
 T3WL="-t 0 -b 2000 -q 0.4999995 -m 2 -r 559"
 
-def report(results):
-    names = set([name for name, workers, result in results])
-    for exp in sorted(names):
-        workers_in_data = set([workers for name, workers, result in results if name==exp])
+# pre-split argument lists for the workloads the driver below uses
+T2L_ARGS = T2L.split()
+T3L_ARGS = T3L.split()
+
+def report():
+    names = sorted(set(name for name, workers in agg))
+    for exp in names:
         mean_1 = None
-        for w in sorted(workers_in_data):
-            data = [result for name, workers, result in results if name==exp and workers==w]
-            n, mean, variance = online_variance(data)
-            stdev = math.sqrt(variance)
+        for w in sorted(workers for name, workers in agg if name==exp):
+            n, mean, M2 = agg[(exp, w)]
+            variance = M2/(n - 1) if n > 1 else float('nan')
             sem = math.sqrt(variance / n)
             if w == 1: mean_1 = mean
             if w != 1 and mean_1: speedup = "speedup={}".format(mean_1/mean)
@@ -159,31 +262,57 @@ def report(results):
             print("{0:<16}: {1:<8.2f} var={2:<6.2f} se={3:<6.2f} n={4:<5d} {5}".format(exp+"-"+str(w), mean, variance, sem, n, speedup))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Lace benchmarks")
+    parser.add_argument("--cold", action="store_true", help="drop cached pages of the benchmark programs before each run")
+    parser.add_argument("--levels", choices=("fast", "full"), default="fast",
+                        help="with 'fast' (default), run the long UTS workloads only at the full worker count; 'full' runs them at every worker count")
+    parser.add_argument("--max-cores", type=int, default=None, help="number of cores to use (default: all cores we may run on)")
+    opts = parser.parse_args()
+
     # Initialize experiments
     experiments = []
 
-    # determine number of cores
-    max_cores = multiprocessing.cpu_count()
+    # determine number of cores; respect any cgroup/taskset affinity mask,
+    # since running more workers than we are allowed oversubscribes
+    if opts.max_cores != None:
+        max_cores = opts.max_cores
+    elif hasattr(os, 'sched_getaffinity'):
+        max_cores = len(os.sched_getaffinity(0))
+    else:
+        max_cores = multiprocessing.cpu_count()
+
+    # check which benchmark programs exist, once
+    have = {prog: os.path.isfile(prog) for prog in
+            ('fib-lace', 'uts-lace', 'queens-lace', 'matmul-lace',
+             'fib-seq', 'uts-seq', 'queens-seq', 'matmul-seq')}
 
-    for w in (1,max_cores):
-        if os.path.isfile('fib-lace'):
+    # the small workloads run at every worker count so speedups can be
+    # computed; the long UTS workloads default to the full worker count only
+    small_workers = (1, max_cores)
+    large_workers = small_workers if opts.levels == "full" else (max_cores,)
+
+    if have['fib-lace']:
+        for w in small_workers:
             experiments.append(("fib",("./fib-lace", "-w", str(w), "50"), w))
-        if os.path.isfile('uts-lace'):
-            experiments.append(("uts-t2l",["./uts-lace", "-w", str(w)] + globals()["T2L"].split(), w))
-            experiments.append(("uts-t3l",["./uts-lace", "-w", str(w)] + globals()["T3L"].split(), w))
-        if os.path.isfile('queens-lace'):
+    if have['uts-lace']:
+        for w in large_workers:
+            experiments.append(("uts-t2l",["./uts-lace", "-w", str(w)] + T2L_ARGS, w))
+            experiments.append(("uts-t3l",["./uts-lace", "-w", str(w)] + T3L_ARGS, w))
+    if have['queens-lace']:
+        for w in small_workers:
             experiments.append(("queens",("./queens-lace", "-w", str(w), "15"), w))
-        if os.path.isfile('matmul-lace'):
+    if have['matmul-lace']:
+        for w in small_workers:
             experiments.append(("matmul",("./matmul-lace", "-w", str(w), "4096"), w))
 
-    if os.path.isfile('fib-seq'):
+    if have['fib-seq']:
         experiments.append(("fib-seq",("./fib-seq", "50"), 1))
-    if os.path.isfile('uts-seq'):
-        experiments.append(("uts-t2l-seq",["./uts-seq"] + globals()["T2L"].split(), 1))
-        experiments.append(("uts-t3l-seq",["./uts-seq"] + globals()["T3L"].split(), 1))
-    if os.path.isfile('queens-seq'):
+    if have['uts-seq']:
+        experiments.append(("uts-t2l-seq",["./uts-seq"] + T2L_ARGS, 1))
+        experiments.append(("uts-t3l-seq",["./uts-seq"] + T3L_ARGS, 1))
+    if have['queens-seq']:
         experiments.append(("queens-seq",("./queens-seq", "15"), 1))
-    if os.path.isfile('matmul-seq'):
+    if have['matmul-seq']:
         experiments.append(("matmul-seq",("./matmul-seq", "4096"), 1))
 
     outdir = 'exp-out'
@@ -193,26 +322,40 @@ if __name__ == "__main__":
 
     results = []
 
-    # Get existing results
-    for i in itertools.count():
-        new_results = False
-        random.shuffle(experiments)
-        for name, call, workers in experiments:
-            result = run_item_file(name, call, workers, "{}/{}-{}-{}".format(outdir, name, workers, i), dry=True)
-            if result != None:
-                results.append((name, workers, float(result['Ti'])))
-                new_results = True
-        if not new_results: break
-
-    report(results)
+    # Get existing results with a single pass over the output directory;
+    # the filenames encode (name, workers, iteration)
+    fname_re = re.compile(r'^(.+)-(\d+)-(\d+)$')
+    known = set((name, workers) for name, call, workers in experiments)
+    for entry in os.scandir(outdir):
+        m = fname_re.match(entry.name)
+        if m == None: continue
+        name, workers = m.group(1), int(m.group(2))
+        if (name, workers) not in known: continue
+        with open(entry.path, "rb") as out:
+            times = proc_result(out.read())
+        if times and 'Ti' in times:
+            print("Retrieved {}-{} from previous run... {} seconds!".format(name, workers, times["Ti"]))
+            record_result(results, name, workers, float(times['Ti']))
+        else:
+            print("Discarding previous run of {}-{}.".format(name, workers))
+            os.unlink(entry.path)
+
+    report()
     results_to_file(results, "results.csv")
     print()
 
+    # warm up each benchmark binary with one unmeasured run; the first
+    # invocation pays cold-cache and page-fault costs that inflate variance
+    warmed = set()
+    for name, call, workers in experiments:
+        if call[0] in warmed or not os.path.isfile(call[0]): continue
+        warmed.add(call[0])
+        print("Warming up {}...".format(call[0]))
+        subprocess.call(call, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=False)
+
     for i in itertools.count():
-        random.shuffle(experiments)
-        for name, call, workers in experiments:
-            result = run_item_file(name, call, workers, "{}/{}-{}-{}".format(outdir, name, workers, i), fresh=True)
-            if result != None: results.append((name, workers, float(result['Ti'])))
+        for name, workers, t in run_iteration(experiments, outdir, i, max_cores, cold=opts.cold):
+            record_result(results, name, workers, t)
         print("\nResults after {} iterations:".format(i+1))
-        report(results)
+        report()
         print()